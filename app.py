@@ -4,26 +4,59 @@ Flask Backend with Context-Aware NLP
 """
 
 from flask import Flask, request, jsonify
+from flask.json.provider import JSONProvider, DefaultJSONProvider
 from flask_cors import CORS
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
 import os
+import re
 import logging
 import sys
+import threading
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 
 from models import db, User, Chatbot, Conversation, Message, EmotionAnalysis
-from nlp_engine import analyze_and_respond, initialize_nlp
-from sqlalchemy import event
+from nlp_engine import analyze_and_respond, initialize_nlp, NLP_READY
+from sqlalchemy import event, func, text, select, delete, tuple_
 from sqlalchemy.engine import Engine
 
+# Under gunicorn's gevent workers, let psycopg2 yield while waiting on Postgres
+try:
+    from gevent import monkey
+    GEVENT_PATCHED = monkey.is_module_patched('socket')
+except ImportError:
+    GEVENT_PATCHED = False
+
+if GEVENT_PATCHED:
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
 # Logging
 logging.basicConfig(level=logging.INFO, stream=sys.stdout)
 logger = logging.getLogger(__name__)
 
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson (C serializer, native datetime support)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=DefaultJSONProvider.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=DefaultJSONProvider.default)
+        return self._app.response_class(body, mimetype='application/json')
+
+
 # Flask app
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # Config
 DATABASE_URL = os.environ.get('DATABASE_URL')
@@ -34,7 +67,45 @@ app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-secret-key')
 app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL or 'sqlite:///melo.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-ALLOWED_ORIGINS = os.environ.get('CORS_ORIGINS', 'http://localhost:3000').split(',')
+# KDF used for new password hashes (Werkzeug's memory-hard scrypt default;
+# the cost is kept off the request threads by KDF_POOL). Existing hashes keep
+# verifying since the method is stored in the hash itself
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+
+# Small dedicated pool so signup bursts don't stall workers serving chat/history.
+# Patched threading only yields greenlets, so under gevent use its pool of real
+# OS threads for the CPU-bound hashing
+if GEVENT_PATCHED:
+    from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+    KDF_POOL = GeventThreadPoolExecutor(max_workers=2)
+else:
+    KDF_POOL = ThreadPoolExecutor(max_workers=2)
+
+# Postgres: reuse warm pooled connections (LIFO), transparently replace ones
+# the proxy dropped, and batch multi-row INSERT/UPDATE into few round-trips.
+# Pool limits are per worker process: (pool_size + max_overflow) * WEB_CONCURRENCY
+# must stay under the server's max_connections (100 by default); the defaults
+# give 4 workers at most 60 connections
+ENGINE_OPTIONS = {}
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+    ENGINE_OPTIONS.update({
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', '5')),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', '10')),
+        'pool_pre_ping': True,
+        'pool_recycle': 280,
+        'pool_use_lifo': True,
+        'executemany_mode': 'values_plus_batch',
+        'insertmanyvalues_page_size': 1000
+    })
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = ENGINE_OPTIONS
+
+# A single anchored regex (e.g. ^https://(.*\.)?melo\.app$) is matched in one
+# pass instead of checking each listed origin in turn
+CORS_ORIGIN_REGEX = os.environ.get('CORS_ORIGIN_REGEX')
+if CORS_ORIGIN_REGEX:
+    ALLOWED_ORIGINS = re.compile(CORS_ORIGIN_REGEX)
+else:
+    ALLOWED_ORIGINS = os.environ.get('CORS_ORIGINS', 'http://localhost:3000').split(',')
 CORS(app, resources={
     r"/api/*": {
         "origins": ALLOWED_ORIGINS,
@@ -84,20 +155,53 @@ def set_security_headers(response):
     response.headers['X-Frame-Options'] = 'SAMEORIGIN'
     return response
 
+# Arbitrary app-wide key for pg_advisory_lock ('melo')
+STARTUP_LOCK_ID = 0x6d656c6f
+
+
+@contextmanager
+def startup_lock():
+    """
+    Serialize schema setup and seeding across gunicorn workers, which each run
+    it at import: concurrent CREATE TABLE fails in all but one worker and each
+    could seed its own chatbot. Postgres only; SQLite dev runs one process.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        yield
+        return
+
+    with db.engine.connect() as conn:
+        conn.execute(text('SELECT pg_advisory_lock(:id)'), {'id': STARTUP_LOCK_ID})
+        try:
+            yield
+        finally:
+            conn.execute(text('SELECT pg_advisory_unlock(:id)'), {'id': STARTUP_LOCK_ID})
+
+
 # Initialize
 with app.app_context():
-    db.create_all()
+    with startup_lock():
+        db.create_all()
 
-    # Run cleanup on startup to fix any bad state
-    cleanup_orphaned_analyses()
+        # Run cleanup on startup to fix any bad state
+        cleanup_orphaned_analyses()
 
-    chatbot = Chatbot.query.first()
-    if not chatbot:
-        chatbot = Chatbot(name='Melo', model_version='2.0-Advanced', status='active')
-        db.session.add(chatbot)
-        db.session.commit()
+        chatbot = Chatbot.query.first()
+        if not chatbot:
+            chatbot = Chatbot(name='Melo', model_version='2.0-Advanced', status='active')
+            db.session.add(chatbot)
+            db.session.commit()
 
-    initialize_nlp()
+    # The chatbot rows are effectively static; resolve the active one once
+    # instead of looking it up on every chat
+    active_chatbot = Chatbot.query.filter_by(status='active').first()
+    if not active_chatbot:
+        logger.warning("No active chatbot configured - new conversations will fail")
+    app.config['ACTIVE_CHATBOT_ID'] = active_chatbot.chatbot_id if active_chatbot else None
+
+# NLP setup runs in the background so workers boot and answer healthchecks
+# immediately; /api/chat waits on NLP_READY
+threading.Thread(target=initialize_nlp, daemon=True).start()
 
 
 # ==================== AUTH ====================
@@ -116,7 +220,11 @@ def signup():
         if User.query.filter_by(username=username).first():
             return jsonify({'error': 'Username exists'}), 409
 
-        user = User(username=username, password_hash=generate_password_hash(password))
+        password_hash = KDF_POOL.submit(
+            generate_password_hash, password, method=PASSWORD_HASH_METHOD
+        ).result()
+
+        user = User(username=username, password_hash=password_hash)
         db.session.add(user)
         db.session.commit()
 
@@ -151,10 +259,15 @@ def login():
 
 # ==================== CHAT ====================
 
+HEALTH_CHECK_SQL = text('SELECT 1')
+
+
 @app.route('/api/health', methods=['GET'])
 def health():
     try:
-        db.session.execute('SELECT 1')
+        # Plain pooled connection: no ORM session or transaction bookkeeping
+        with db.engine.connect() as connection:
+            connection.execute(HEALTH_CHECK_SQL)
         return jsonify({'status': 'healthy', 'database': 'connected'}), 200
     except:
         return jsonify({'status': 'unhealthy'}), 500
@@ -172,10 +285,14 @@ def chat():
         if not user_id or not user_message or len(user_message) > 1000:
             return jsonify({'error': 'Invalid input'}), 400
 
-        user = User.query.get(user_id)
-        if not user:
+        # Existence check only: fetch the key, not the whole user row
+        user_exists = db.session.query(User.user_id).filter_by(user_id=user_id).scalar()
+        if not user_exists:
             return jsonify({'error': 'User not found'}), 404
 
+        if not NLP_READY.wait(timeout=5):
+            return jsonify({'error': 'Warming up, please retry'}), 503
+
         # Get/create conversation
         if conversation_id:
             conversation = Conversation.query.get(conversation_id)
@@ -184,22 +301,18 @@ def chat():
         else:
             conversation = None
 
-        if not conversation:
-            chatbot = Chatbot.query.filter_by(status='active').first()
-            conversation = Conversation(user_id=user_id, chatbot_id=chatbot.chatbot_id, status='active')
-            db.session.add(conversation)
-            db.session.flush()
+        received_at = datetime.utcnow()
 
-        # Save user message
-        user_msg = Message(
-            conversation_id=conversation.conversation_id,
-            sender_type='user',
-            message_text=user_message,
-            message_type='text'
-        )
-        db.session.add(user_msg)
-
-        # Analyze with user context (PASS USER_ID FOR CONTEXT LEARNING)
+        if not conversation:
+            conversation = Conversation(
+                user_id=user_id,
+                chatbot_id=app.config['ACTIVE_CHATBOT_ID'],
+                started_at=received_at,
+                status='active'
+            )
+
+        # Analyze before touching the session so nothing is flushed early;
+        # a new conversation has no history to load
         analysis = analyze_and_respond(
             user_message,
             user_id=user_id,
@@ -207,29 +320,35 @@ def chat():
             db=db
         )
 
-        # Save emotion
-        emotion_analysis = EmotionAnalysis(
-            detected_emotion=analysis['emotion'],
-            confidence_score=analysis['confidence']
+        # Write conversation, both messages and the emotion in one flush;
+        # the two message rows go out as a single batched INSERT ... RETURNING
+        user_msg = Message(
+            conversation=conversation,
+            sender_type='user',
+            message_text=user_message,
+            message_type='text',
+            timestamp=received_at
+        )
+        user_msg.emotion_analysis = EmotionAnalysis(
+            detected_emotion=analysis.emotion,
+            confidence_score=analysis.confidence
         )
-        user_msg.emotion_analysis = emotion_analysis
 
-        # Save bot response
         bot_msg = Message(
-            conversation_id=conversation.conversation_id,
+            conversation=conversation,
             sender_type='bot',
-            message_text=analysis['response'],
-            message_type='suggestion' if analysis['coping_strategy'] else 'text'
+            message_text=analysis.response,
+            message_type='suggestion' if analysis.coping_strategy else 'text'
         )
-        db.session.add(bot_msg)
+        db.session.add_all([user_msg, bot_msg])
         db.session.commit()
 
         return jsonify({
-            'reply': analysis['response'],
-            'emotion': analysis['emotion'],
-            'confidence': round(analysis['confidence'], 4),
-            'coping_strategy': analysis['coping_strategy'],
-            'needs_escalation': analysis['needs_escalation'],
+            'reply': analysis.response,
+            'emotion': analysis.emotion,
+            'confidence': round(analysis.confidence, 4),
+            'coping_strategy': analysis.coping_strategy,
+            'needs_escalation': analysis.needs_escalation,
             'conversation_id': conversation.conversation_id
         }), 200
 
@@ -241,6 +360,48 @@ def chat():
 
 # ==================== HISTORY ====================
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def make_cursor(timestamp, row_id):
+    """
+    Keyset cursor '<ISO timestamp>_<id>': the id breaks ties between rows
+    sharing a timestamp so none are skipped at a page boundary
+    """
+    return f"{timestamp.isoformat()}_{row_id}"
+
+
+def parse_cursor(raw_cursor):
+    """(timestamp, id) from make_cursor's format; ValueError if malformed"""
+    timestamp, row_id = raw_cursor.rsplit('_', 1)
+    return datetime.fromisoformat(timestamp), int(row_id)
+
+
+def get_page_args():
+    """
+    Keyset pagination args: page size and a (timestamp, id) cursor.
+    Opt-in: without 'limit' or 'cursor' the limit is None (full listing).
+    Raises ValueError for a malformed cursor.
+    """
+    raw_cursor = request.args.get('cursor')
+    cursor = parse_cursor(raw_cursor) if raw_cursor else None
+
+    limit = request.args.get('limit', type=int)
+    if limit is None and cursor is None:
+        return None, None
+    limit = max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+    return limit, cursor
+
+
+def fetch_page(query, limit):
+    """Run query, fetching one extra row to know whether another page exists"""
+    if limit is None:
+        return query.all(), False
+    rows = query.limit(limit + 1).all()
+    return rows[:limit], len(rows) > limit
+
+
 @app.route('/api/conversations', methods=['GET'])
 def get_conversations():
     try:
@@ -248,21 +409,41 @@ def get_conversations():
         if not user_id:
             return jsonify({'error': 'user_id required'}), 400
 
-        conversations = Conversation.query.filter_by(user_id=user_id).order_by(
-            Conversation.started_at.desc()
-        ).all()
+        try:
+            limit, cursor = get_page_args()
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+        # Count messages in the same query instead of one COUNT per conversation
+        query = db.session.query(
+            Conversation, func.count(Message.message_id)
+        ).outerjoin(Message).filter(
+            Conversation.user_id == user_id
+        )
+        if cursor:
+            query = query.filter(tuple_(Conversation.started_at, Conversation.conversation_id) < cursor)
+
+        conversations, has_more = fetch_page(
+            query.group_by(Conversation.conversation_id).order_by(
+                Conversation.started_at.desc(), Conversation.conversation_id.desc()
+            ),
+            limit
+        )
 
         result = [
             {
                 'conversation_id': c.conversation_id,
-                'started_at': c.started_at.isoformat(),
+                'started_at': c.started_at,
                 'status': c.status,
-                'message_count': Message.query.filter_by(conversation_id=c.conversation_id).count()
+                'message_count': message_count
             }
-            for c in conversations
+            for c, message_count in conversations
         ]
 
-        return jsonify({'conversations': result}), 200
+        last = conversations[-1][0] if has_more else None
+        next_cursor = make_cursor(last.started_at, last.conversation_id) if last else None
+
+        return jsonify({'conversations': result, 'next_cursor': next_cursor}), 200
     except Exception as e:
         logger.error(f"Error: {e}")
         return jsonify({'error': 'Failed'}), 500
@@ -271,19 +452,39 @@ def get_conversations():
 @app.route('/api/conversations/<int:cid>/messages', methods=['GET'])
 def get_messages(cid):
     try:
-        messages = Message.query.filter_by(conversation_id=cid).order_by(Message.timestamp).all()
+        try:
+            limit, cursor = get_page_args()
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+        # Plain column rows: no ORM instances or identity-map bookkeeping, and
+        # the emotion comes from the same query via an outer join
+        query = db.session.query(
+            Message.message_id,
+            Message.sender_type,
+            Message.message_text,
+            Message.timestamp,
+            EmotionAnalysis.detected_emotion
+        ).outerjoin(EmotionAnalysis).filter(Message.conversation_id == cid)
+        if cursor:
+            query = query.filter(tuple_(Message.timestamp, Message.message_id) > cursor)
+
+        messages, has_more = fetch_page(query.order_by(Message.timestamp, Message.message_id), limit)
 
         result = [
             {
                 'sender_type': m.sender_type,
                 'message_text': m.message_text,
-                'timestamp': m.timestamp.isoformat(),
-                'emotion': m.emotion_analysis.detected_emotion if m.emotion_analysis else None
+                'timestamp': m.timestamp,
+                'emotion': m.detected_emotion
             }
             for m in messages
         ]
 
-        return jsonify({'messages': result}), 200
+        last = messages[-1] if has_more else None
+        next_cursor = make_cursor(last.timestamp, last.message_id) if last else None
+
+        return jsonify({'messages': result, 'next_cursor': next_cursor}), 200
     except Exception as e:
         logger.error(f"Error: {e}")
         return jsonify({'error': 'Failed'}), 500
@@ -315,21 +516,31 @@ def cleanup_old_conversations():
         
         cutoff_date = datetime.utcnow() - timedelta(days=days)
         
-        # Find old conversations
-        old_conversations = Conversation.query.filter(
+        # Set-based deletes: one statement per table instead of one per row.
+        # No session synchronization: nothing deleted here is loaded, so skip
+        # the RETURNING/identity-map pass over every deleted key
+        old_conversation_ids = select(Conversation.conversation_id).where(
             Conversation.user_id == user_id,
             Conversation.started_at < cutoff_date
-        ).all()
-        
-        count = 0
-        for conv in old_conversations:
-            # Delete objects individually to ensure cascades work
-            messages = Message.query.filter_by(conversation_id=conv.conversation_id).all()
-            for msg in messages:
-                db.session.delete(msg)
-
-            db.session.delete(conv)
-            count += 1
+        )
+        old_message_ids = select(Message.message_id).where(
+            Message.conversation_id.in_(old_conversation_ids)
+        )
+
+        db.session.execute(
+            delete(EmotionAnalysis).where(EmotionAnalysis.message_id.in_(old_message_ids))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.execute(
+            delete(Message).where(Message.conversation_id.in_(old_conversation_ids))
+            .execution_options(synchronize_session=False)
+        )
+        count = db.session.execute(
+            delete(Conversation).where(
+                Conversation.user_id == user_id,
+                Conversation.started_at < cutoff_date
+            ).execution_options(synchronize_session=False)
+        ).rowcount
         
         db.session.commit()
         
@@ -338,6 +549,7 @@ def cleanup_old_conversations():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+# Local development only; production runs gunicorn with gevent workers (Procfile)
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -5,11 +5,37 @@ Implements the complete ERD schema with all entities and relationships
 
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Index, JSON
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import relationship
+from sqlalchemy.sql.expression import FunctionElement
 
 db = SQLAlchemy()
 
+# Binary JSON on Postgres, plain JSON elsewhere (SQLite in development)
+JSONType = JSON().with_variant(JSONB(), 'postgresql')
+
+
+class utcnow(FunctionElement):
+    """
+    Current UTC time evaluated by the database inside the INSERT/UPDATE,
+    as a naive timestamp matching the existing columns
+    """
+    type = DateTime()
+    inherit_cache = True
+
+
+@compiles(utcnow)
+def _default_utcnow(element, compiler, **kw):
+    return 'CURRENT_TIMESTAMP'
+
+
+@compiles(utcnow, 'postgresql')
+def _pg_utcnow(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+
 class User(db.Model):
     """
     User entity - stores user information
@@ -21,9 +47,9 @@ class User(db.Model):
     user_id = Column(Integer, primary_key=True, autoincrement=True)
     username = Column(String(100), nullable=False, unique=True)
     password_hash = Column(String(255), nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
-    last_login = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    preferences = Column(Text)  # JSON string for user preferences
+    created_at = Column(DateTime, default=utcnow(), nullable=False)
+    last_login = Column(DateTime, default=utcnow(), onupdate=utcnow())
+    preferences = Column(JSONType)  # User preferences
 
     # Relationships
     conversations = relationship('Conversation', back_populates='user', cascade='all, delete-orphan')
@@ -43,7 +69,7 @@ class Chatbot(db.Model):
     chatbot_id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(100), nullable=False, default='Melo')
     model_version = Column(String(50), nullable=False)
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at = Column(DateTime, default=utcnow(), nullable=False)
     status = Column(String(20), default='active')  # active, inactive, maintenance
 
     # Relationships
@@ -61,11 +87,14 @@ class Conversation(db.Model):
     Relationships: 1-to-N with User, 1-to-N with Chatbot, 1-to-N with Message
     """
     __tablename__ = 'conversations'
+    __table_args__ = (
+        Index('ix_conv_user_started', 'user_id', 'started_at'),
+    )
 
     conversation_id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.user_id'), nullable=False)
     chatbot_id = Column(Integer, ForeignKey('chatbots.chatbot_id'), nullable=False)
-    started_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    started_at = Column(DateTime, default=datetime.utcnow, nullable=False)  # Pagination cursor
     ended_at = Column(DateTime)
     status = Column(String(20), default='active')  # active, completed, abandoned
     conversation_summary = Column(Text)
@@ -87,11 +116,18 @@ class Message(db.Model):
     Relationships: N-to-1 with Conversation, 1-to-1 with Emotion_Analysis
     """
     __tablename__ = 'messages'
+    __table_args__ = (
+        Index('ix_msg_conv_ts', 'conversation_id', 'timestamp'),
+    )
 
     message_id = Column(Integer, primary_key=True, autoincrement=True)
-    conversation_id = Column(Integer, ForeignKey('conversations.conversation_id'), nullable=False)
+    conversation_id = Column(Integer, ForeignKey('conversations.conversation_id', ondelete='CASCADE'),
+                             nullable=False)
     sender_type = Column(String(10), nullable=False)  # 'user' or 'bot'
     message_text = Column(Text, nullable=False)
+    # Python-side default on purpose: ordering needs sub-second precision and
+    # rows inserted in one transaction must differ (pagination cursors also
+    # carry message_id, so equal timestamps are still paged correctly)
     timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
     message_type = Column(String(50))  # text, suggestion, quote, exercise
 
@@ -114,12 +150,12 @@ class EmotionAnalysis(db.Model):
     __tablename__ = 'emotion_analysis'
 
     analysis_id = Column(Integer, primary_key=True, autoincrement=True)
-    message_id = Column(Integer, ForeignKey('messages.message_id'), 
+    message_id = Column(Integer, ForeignKey('messages.message_id', ondelete='CASCADE'),
                        nullable=False, unique=True)
     detected_emotion = Column(String(50), nullable=False)
     confidence_score = Column(db.Float, nullable=False)
-    analysis_timestamp = Column(DateTime, default=datetime.utcnow, nullable=False)
-    secondary_emotions = Column(Text)  # JSON string for other detected emotions
+    analysis_timestamp = Column(DateTime, default=utcnow(), nullable=False)
+    secondary_emotions = Column(JSONType)  # Other detected emotions
 
     # Relationships
     message = relationship('Message', back_populates='emotion_analysis')
@@ -142,7 +178,7 @@ class Feedback(db.Model):
     conversation_id = Column(Integer, ForeignKey('conversations.conversation_id'))
     rating = Column(Integer)  # 1-5 rating scale
     feedback_text = Column(Text)
-    submitted_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    submitted_at = Column(DateTime, default=utcnow(), nullable=False)
     helpful = Column(Boolean)  # Was the chatbot helpful?
 
     # Relationships
@@ -166,7 +202,7 @@ class Therapist(db.Model):
     specialization = Column(String(100))
     phone = Column(String(20))
     availability_status = Column(String(20), default='available')
-    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    created_at = Column(DateTime, default=utcnow(), nullable=False)
     license_number = Column(String(50))
 
     def __repr__(self):
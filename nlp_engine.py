@@ -5,30 +5,60 @@ Melo NLP Engine - Groq API with OpenAI GPT-OSS 120B
 
 import logging
 import os
-from groq import Groq
+import threading
+from functools import lru_cache
+from collections import namedtuple, OrderedDict
+import ahocorasick
+from groq import Groq, Timeout
 from models import Message, Conversation
 
 logger = logging.getLogger(__name__)
 
+# Result of analyze_and_respond: immutable and slot-sized, so fixed results
+# can be shared module-level singletons instead of a fresh dict per call
+NLPResult = namedtuple('NLPResult', [
+    'emotion', 'confidence', 'all_emotions', 'response', 'coping_strategy', 'needs_escalation'
+])
+
 # Initialize Groq client
 client = None
 
+# Bound slow/hung Groq calls so they can't pin a worker; chat requests fall
+# back to pattern responses on expiry. Every call here is interactive, so no
+# SDK retries: a retried timeout would keep the request (and its Groq slot
+# and DB connection) waiting several times over
+GROQ_TIMEOUT = Timeout(10.0, connect=5.0)
+GROQ_MAX_RETRIES = 0
+
+# Per-process cap on in-flight Groq calls so bursts don't run into provider
+# rate limits (429 + retry backoff); a request that can't get a slot quickly
+# is answered by the pattern fallback instead
+GROQ_SLOTS = threading.BoundedSemaphore(int(os.environ.get('GROQ_CONCURRENCY', '8')))
+GROQ_SLOT_WAIT = 0.5
+
+# Set once initialize_nlp has finished (successfully or not); until then
+# requests should wait rather than silently use the pattern fallback
+NLP_READY = threading.Event()
+
 def initialize_nlp():
     """Initialize Groq client"""
     global client
 
-    api_key = os.environ.get('GROQ_API_KEY')
-    if not api_key:
-        logger.warning("GROQ_API_KEY not found - using pattern-based fallback")
-        return False
-
     try:
-        client = Groq(api_key=api_key)
-        logger.info("✓ Groq API initialized with OpenAI GPT-OSS 120B")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to initialize Groq: {e}")
-        return False
+        api_key = os.environ.get('GROQ_API_KEY')
+        if not api_key:
+            logger.warning("GROQ_API_KEY not found - using pattern-based fallback")
+            return False
+
+        try:
+            client = Groq(api_key=api_key, timeout=GROQ_TIMEOUT, max_retries=GROQ_MAX_RETRIES)
+            logger.info("✓ Groq API initialized with OpenAI GPT-OSS 120B")
+            return True
+        except Exception as e:
+            logger.error(f"Failed to initialize Groq: {e}")
+            return False
+    finally:
+        NLP_READY.set()
 
 
 def analyze_and_respond(user_message, user_id=None, conversation_id=None, db=None):
@@ -46,7 +76,12 @@ def analyze_and_respond(user_message, user_id=None, conversation_id=None, db=Non
         try:
             # Get last 20 messages for context (simple approximation of 'whole chat' within reason)
             # Order by descending to get most recent, then reverse for chronological order
-            past_messages = Message.query.filter_by(conversation_id=conversation_id).order_by(Message.timestamp.desc()).limit(20).all()
+            # Only the two needed columns: plain rows, no ORM object hydration
+            past_messages = db.session.query(
+                Message.sender_type, Message.message_text
+            ).filter(
+                Message.conversation_id == conversation_id
+            ).order_by(Message.timestamp.desc()).limit(20).all()
             past_messages.reverse()
 
             for msg in past_messages:
@@ -57,22 +92,33 @@ def analyze_and_respond(user_message, user_id=None, conversation_id=None, db=Non
 
     # Try Groq API with GPT-OSS 120B
     if client:
-        try:
-            return get_groq_response(user_message, history)
-        except Exception as e:
-            logger.warning(f"Groq API failed: {e}, using fallback")
+        # Opening messages depend on the text alone: serve cached replies
+        # without taking a Groq slot
+        cache_key = None
+        if not history:
+            cache_key = normalize_message(user_message)
+            cached = get_cached_groq_response(cache_key)
+            if cached is not None:
+                return cached
+
+        if GROQ_SLOTS.acquire(timeout=GROQ_SLOT_WAIT):
+            try:
+                result = get_groq_response(user_message, history)
+                if cache_key is not None:
+                    cache_groq_response(cache_key, result)
+                return result
+            except Exception as e:
+                logger.warning(f"Groq API failed: {e}, using fallback")
+            finally:
+                GROQ_SLOTS.release()
+        else:
+            logger.warning("Groq concurrency limit reached, using fallback")
 
     # Fallback to pattern-based
     return get_pattern_response(user_message)
 
 
-def get_groq_response(user_message, history=None):
-    """Get response from Groq API using OpenAI GPT-OSS 120B"""
-
-    if history is None:
-        history = []
-
-    system_prompt = """You are Melo — an empathetic AI therapist and mental-health companion.
+SYSTEM_PROMPT = """You are Melo — an empathetic AI therapist and mental-health companion.
 Core Identity & Purpose
 Melo is a supportive emotional companion, not a clinician.
 Your job is to listen, validate, and gently guide, never to diagnose or treat.
@@ -153,15 +199,54 @@ Melo offers emotional presence, gentle support, and understanding.
 Melo does not diagnose, instruct, or replace professionals.
 Melo maintains strict safety boundaries and prioritizes compassion above all else."""
 
-    # Construct messages with history
-    messages = [{"role": "system", "content": system_prompt}]
-    messages.extend(history)
+# Built once and reused as the first message of every request; keeping the
+# prefix byte-identical also lets the provider reuse its cached prompt prefix
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+def normalize_message(message):
+    """Lowercase and collapse whitespace: the lookup key for cached results"""
+    return " ".join(message.lower().split())
+
+
+# Opening-message replies keyed on the normalized text, least recently used
+# evicted first; values are shared immutable NLPResults
+GROQ_CACHE_SIZE = 512
+groq_cache = OrderedDict()
+groq_cache_lock = threading.Lock()
+
+
+def get_cached_groq_response(key):
+    """
+    Cached Groq response for a normalized conversation-opening message, or
+    None. Repeated openers ("hi", "help") skip the API round-trip.
+    """
+    with groq_cache_lock:
+        result = groq_cache.get(key)
+        if result is not None:
+            groq_cache.move_to_end(key)
+        return result
 
-    # Ensure the user's current message is last, if not already in history
-    # (The app saves the user message BEFORE calling this function, so it MIGHT be in history already if DB commit happened)
-    # Checking if the last message in history matches user_message to avoid duplication
-    if not history or history[-1]['content'] != user_message:
-        messages.append({"role": "user", "content": user_message})
+
+def cache_groq_response(key, result):
+    """Store a successful opening-message response, evicting the oldest"""
+    with groq_cache_lock:
+        groq_cache[key] = result
+        if len(groq_cache) > GROQ_CACHE_SIZE:
+            groq_cache.popitem(last=False)
+
+
+def get_groq_response(user_message, history=None):
+    """Get response from Groq API using OpenAI GPT-OSS 120B"""
+
+    if history is None:
+        history = []
+
+    # Construct messages with history; the app analyzes the message before
+    # saving it, so the current message is never in history and goes last
+    messages = [SYSTEM_MESSAGE]
+    messages.extend(history)
+    messages.append({"role": "user", "content": user_message})
 
     try:
         response = client.chat.completions.create(
@@ -189,20 +274,42 @@ Melo maintains strict safety boundaries and prioritizes compassion above all els
         # Current logic:
         # detect_emotion_from_response(user_message, bot_response) -> scans user_message only!
 
-        return {
-            'emotion': emotion,
-            'confidence': 0.95,  # GPT-OSS 120B has high accuracy
-            'all_emotions': [],
-            'response': bot_response,
-            'coping_strategy': None,
-            'needs_escalation': False
-        }
+        return NLPResult(
+            emotion=emotion,
+            confidence=0.95,  # GPT-OSS 120B has high accuracy
+            all_emotions=(),
+            response=bot_response,
+            coping_strategy=None,
+            needs_escalation=False
+        )
 
     except Exception as e:
         logger.error(f"Groq API error: {e}")
         raise
 
 
+# Checked in priority order: the first emotion listed wins
+EMOTION_KEYWORDS = {
+    'Sad': ('sad', 'depressed', 'down', 'unhappy', 'devastated', 'heartbroken', 'miserable', 'grief'),
+    'Anxious': ('anxious', 'worried', 'nervous', 'scared', 'afraid', 'panic', 'stress', 'fear'),
+    'Angry': ('angry', 'mad', 'frustrated', 'irritated', 'furious', 'annoyed', 'rage'),
+    'Happy': ('happy', 'good', 'great', 'wonderful', 'excited', 'joy', 'glad', 'amazing'),
+    'Lonely': ('lonely', 'alone', 'isolated', 'disconnected', 'abandoned', 'forgotten'),
+    'Hopeful': ('hope', 'hopeful', 'optimistic', 'better', 'improving', 'positive'),
+    'Confused': ('confused', 'unsure', 'lost', 'unclear', 'dont know', 'bewildered'),
+    'Overwhelmed': ('overwhelmed', 'too much', 'drowning', 'cant handle', 'swamped')
+}
+
+# All keywords in one Aho-Corasick automaton, so a single linear pass finds
+# every match; payload is (priority, emotion)
+EMOTION_AUTOMATON = ahocorasick.Automaton()
+for priority, (emotion, keywords) in enumerate(EMOTION_KEYWORDS.items()):
+    for keyword in keywords:
+        if keyword not in EMOTION_AUTOMATON:
+            EMOTION_AUTOMATON.add_word(keyword, (priority, emotion))
+EMOTION_AUTOMATON.make_automaton()
+
+
 def detect_emotion_from_response(user_message, bot_response):
     """Simple emotion detection from message keywords"""
 
@@ -210,89 +317,122 @@ def detect_emotion_from_response(user_message, bot_response):
     # (Bot response often contains the reflected emotion: "It sounds like you are feeling sad")
     combined_text = (user_message + " " + bot_response).lower()
 
-    emotion_keywords = {
-        'Sad': ['sad', 'depressed', 'down', 'unhappy', 'devastated', 'heartbroken', 'miserable', 'grief'],
-        'Anxious': ['anxious', 'worried', 'nervous', 'scared', 'afraid', 'panic', 'stress', 'fear'],
-        'Angry': ['angry', 'mad', 'frustrated', 'irritated', 'furious', 'annoyed', 'rage'],
-        'Happy': ['happy', 'good', 'great', 'wonderful', 'excited', 'joy', 'glad', 'amazing'],
-        'Lonely': ['lonely', 'alone', 'isolated', 'disconnected', 'abandoned', 'forgotten'],
-        'Hopeful': ['hope', 'hopeful', 'optimistic', 'better', 'improving', 'positive'],
-        'Confused': ['confused', 'unsure', 'lost', 'unclear', 'dont know', 'bewildered'],
-        'Overwhelmed': ['overwhelmed', 'too much', 'drowning', 'cant handle', 'swamped']
-    }
-
-    for emotion, keywords in emotion_keywords.items():
-        if any(kw in combined_text for kw in keywords):
-            return emotion
+    best = min((hit for _, hit in EMOTION_AUTOMATON.iter(combined_text)), default=None)
+    if best:
+        return best[1]
 
     return 'Neutral'
 
 
+CRISIS_KEYWORDS = ('suicide', 'kill myself', 'want to die', 'end it all', 'self harm')
+
+# Fixed fallback results are built once and shared (NLPResult is immutable)
+CRISIS_RESPONSE = NLPResult(
+    emotion='Crisis',
+    confidence=1.0,
+    all_emotions=(),
+    response="I'm very concerned about your safety. Please reach out for immediate help.",
+    coping_strategy=None,
+    needs_escalation=True
+)
+
+
+# Fallback replies keyed by trigger word, checked in order
+PATTERN_RESPONSES = {
+    'sad': {
+        'emotion': 'Sad',
+        'response': "I hear the sadness in your words. Its okay to feel this way. I'm here to listen without judgment. What's been weighing on your heart?"
+    },
+    'anxious': {
+        'emotion': 'Anxious',
+        'response': "I can sense your anxiety. That must feel overwhelming. Let's take this one step at a time. What's making you feel anxious right now?"
+    },
+    'angry': {
+        'emotion': 'Angry',
+        'response': "I hear your frustration and anger. Those feelings are completely valid. What happened that's making you feel this way?"
+    },
+    'happy': {
+        'emotion': 'Happy',
+        'response': "It's wonderful to hear some positivity! I'm glad you're experiencing something good. What's bringing you joy today?"
+    },
+    'lonely': {
+        'emotion': 'Lonely',
+        'response': "Loneliness can feel so heavy. But you're not truly alone - I'm here with you. Would you like to talk about what you're feeling?"
+    },
+    'overwhelmed': {
+        'emotion': 'Overwhelmed',
+        'response': "You're carrying a lot right now. Let's break this down into smaller pieces together. What's weighing on you most?"
+    }
+}
+
+PATTERN_RESULTS = {
+    keyword: NLPResult(
+        emotion=response_data['emotion'],
+        confidence=0.85,
+        all_emotions=(),
+        response=response_data['response'],
+        coping_strategy=None,
+        needs_escalation=False
+    )
+    for keyword, response_data in PATTERN_RESPONSES.items()
+}
+
+
+# Crisis phrases and fallback trigger words in one automaton, so a single
+# pass over the message answers both; payload is (priority, tag) with
+# crisis ranked first and triggers in PATTERN_RESPONSES order
+PATTERN_AUTOMATON = ahocorasick.Automaton()
+for keyword in CRISIS_KEYWORDS:
+    PATTERN_AUTOMATON.add_word(keyword, (0, 'crisis'))
+for priority, keyword in enumerate(PATTERN_RESPONSES, start=1):
+    if keyword not in PATTERN_AUTOMATON:
+        PATTERN_AUTOMATON.add_word(keyword, (priority, keyword))
+PATTERN_AUTOMATON.make_automaton()
+
+
+@lru_cache(maxsize=4096)
+def match_pattern(msg):
+    """
+    Classify a normalized (lowercased, whitespace-collapsed) message:
+    'crisis', the matching PATTERN_RESPONSES keyword, or None.
+    Pure, so repeated short messages ("hi", "i'm sad") are cache hits.
+    """
+    best = None
+    for _, hit in PATTERN_AUTOMATON.iter(msg):
+        if hit[0] == 0:
+            return 'crisis'
+        if best is None or hit < best:
+            best = hit
+
+    return best[1] if best else None
+
+
 def get_pattern_response(user_message):
     """Fallback pattern-based response if API fails"""
 
-    msg = user_message.lower()
+    match = match_pattern(normalize_message(user_message))
 
     # Crisis detection
-    if any(word in msg for word in ['suicide', 'kill myself', 'want to die', 'end it all', 'self harm']):
-        return {
-            'emotion': 'Crisis',
-            'confidence': 1.0,
-            'all_emotions': [],
-            'response': "I'm very concerned about your safety. Please reach out for immediate help.",
-            'coping_strategy': None,
-            'needs_escalation': True
-        }
+    if match == 'crisis':
+        return CRISIS_RESPONSE
 
     # Simple emotion detection and responses
-    emotion_responses = {
-        'sad': {
-            'emotion': 'Sad',
-            'response': "I hear the sadness in your words. Its okay to feel this way. I'm here to listen without judgment. What's been weighing on your heart?"
-        },
-        'anxious': {
-            'emotion': 'Anxious',
-            'response': "I can sense your anxiety. That must feel overwhelming. Let's take this one step at a time. What's making you feel anxious right now?"
-        },
-        'angry': {
-            'emotion': 'Angry',
-            'response': "I hear your frustration and anger. Those feelings are completely valid. What happened that's making you feel this way?"
-        },
-        'happy': {
-            'emotion': 'Happy',
-            'response': "It's wonderful to hear some positivity! I'm glad you're experiencing something good. What's bringing you joy today?"
-        },
-        'lonely': {
-            'emotion': 'Lonely',
-            'response': "Loneliness can feel so heavy. But you're not truly alone - I'm here with you. Would you like to talk about what you're feeling?"
-        },
-        'overwhelmed': {
-            'emotion': 'Overwhelmed',
-            'response': "You're carrying a lot right now. Let's break this down into smaller pieces together. What's weighing on you most?"
-        }
-    }
-
-    for keyword, response_data in emotion_responses.items():
-        if keyword in msg:
-            return {
-                'emotion': response_data['emotion'],
-                'confidence': 0.85,
-                'all_emotions': [],
-                'response': response_data['response'],
-                'coping_strategy': None,
-                'needs_escalation': False
-            }
+    if match:
+        return PATTERN_RESULTS[match]
 
     return get_neutral_response()
 
 
+NEUTRAL_RESPONSE = NLPResult(
+    emotion='Neutral',
+    confidence=0.5,
+    all_emotions=(),
+    response="I'm here to listen and support you. What's on your mind today? Feel free to share whatever you're comfortable with.",
+    coping_strategy=None,
+    needs_escalation=False
+)
+
+
 def get_neutral_response():
-    """Default neutral response"""
-    return {
-        'emotion': 'Neutral',
-        'confidence': 0.5,
-        'all_emotions': [],
-        'response': "I'm here to listen and support you. What's on your mind today? Feel free to share whatever you're comfortable with.",
-        'coping_strategy': None,
-        'needs_escalation': False
-    }
+    """Default neutral response (shared, immutable)"""
+    return NEUTRAL_RESPONSE